@@ -10,38 +10,53 @@ Requirements (system):
   - ffmpeg installed and available in PATH
 
 Install deps:
-  pip install -U yt-dlp python-telegram-bot==21.* feedparser python-dotenv
+  pip install -U yt-dlp "python-telegram-bot[rate-limiter]==21.*" feedparser python-dotenv aiohttp orjson
 
 Env variables (create .env or set in your shell):
   TELEGRAM_BOT_TOKEN=123456:ABC...
   TARGET_CHAT_ID=-1001234567890          # chat/channel/user where videos are posted in auto-sync mode
   YT_CHANNEL_ID=UCxxxxxxxxxxxxxxxxxx     # optional: enables auto-sync from this channel
-  POLL_INTERVAL=300                      # optional: seconds between RSS checks (default 300)
+  POLL_INTERVAL=300                      # optional: min seconds between RSS checks (default 300; stretched for quiet channels)
   MAX_DURATION_SECONDS=75                # optional: ignore videos longer than this (default 75)
   MAX_HEIGHT=1080                        # optional: cap video height for download (default 1080)
+  MAX_CONCURRENT_DOWNLOADS=4             # optional: parallel yt-dlp/ffmpeg jobs (default min(4, CPU count))
+  SYNC_CONCURRENCY=3                     # optional: new channel videos downloaded at once (default 3)
+  LOCAL_BOT_API_URL=http://localhost:8081  # optional: self-hosted telegram-bot-api server started with --local
 
 Notes:
   • Telegram Bot API upload size is limited (bots). Shorts are usually fine; very large files may fail.
+    python-telegram-bot reads the whole file into memory for the upload, so RAM per send ≈ file size.
+    With LOCAL_BOT_API_URL the limit is 2 GB and videos are handed over by path, without a multipart
+    upload; the server must be able to read the bot's temp dir (same host/volume).
   • Respect YouTube/Telegram Terms and copyright. Only re-share content you have rights to.
 """
 from __future__ import annotations
 
 import asyncio
+import calendar
+import collections
+import concurrent.futures
 import contextlib
 import dataclasses
-import json
+import functools
 import os
+import queue
 import re
+import shutil
+import statistics
+import subprocess
 import tempfile
 import time
 from pathlib import Path
 from typing import Optional, Dict, Any
 
+import aiohttp
 import feedparser
+import orjson
 from dotenv import load_dotenv
-from telegram import Update
+from telegram import InputFile, Update
 from telegram.constants import ParseMode
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters, ContextTypes
 
 from yt_dlp import YoutubeDL
 
@@ -50,22 +65,88 @@ load_dotenv()
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "").strip()
 TARGET_CHAT_ID = os.getenv("TARGET_CHAT_ID", "").strip()  # used in auto-sync mode
+LOCAL_BOT_API_URL = os.getenv("LOCAL_BOT_API_URL", "").strip().rstrip("/")
 YT_CHANNEL_ID = os.getenv("YT_CHANNEL_ID", "").strip()
 POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "300"))
 MAX_DURATION_SECONDS = int(os.getenv("MAX_DURATION_SECONDS", "75"))
 MAX_HEIGHT = int(os.getenv("MAX_HEIGHT", "1080"))
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", str(min(4, os.cpu_count() or 1))))
+SYNC_CONCURRENCY = int(os.getenv("SYNC_CONCURRENCY", "3"))
+MAX_POLL_INTERVAL = 24 * 3600
+CAPTION_LIMIT = 1024
 STATE_FILE = Path(os.getenv("STATE_FILE", ".yt_shorts_state.json"))
+STATE_LOG = STATE_FILE.with_suffix(".log")
+STATE_COMPACT_EVERY = 1000
+# The channel feed only lists the latest ~15 uploads, so old IDs can be forgotten safely.
+STATE_MAX_ENTRIES = 10_000
 
 YDL_OPTS_BASE = {
     "quiet": True,
     "noprogress": True,
     "restrictfilenames": True,
     "outtmpl": "%(id)s.%(ext)s",
+    "merge_output_format": "mp4",
     "postprocessors": [
-        {"key": "FFmpegVideoConvertor", "preferedformat": "mp4"},  # ensure mp4
+        # the format selector already prefers h264/aac, so a stream-copy remux is enough
+        {"key": "FFmpegVideoRemuxer", "preferedformat": "mp4"},  # ensure mp4
     ],
 }
 
+# Hardware H.264 encoders in order of preference, with the ffmpeg args used for each.
+HW_ENCODERS = {
+    "h264_nvenc": ["-c:v", "h264_nvenc", "-preset", "p4", "-b:v", "4M"],
+    "h264_qsv": ["-c:v", "h264_qsv", "-preset", "medium", "-b:v", "4M"],
+    "h264_videotoolbox": ["-c:v", "h264_videotoolbox", "-b:v", "4M"],
+}
+
+
+FFMPEG = shutil.which("ffmpeg")
+
+
+def detect_hw_encoder() -> Optional[str]:
+    # `ffmpeg -encoders` only lists what was compiled in, so prove each encoder works with a 1-frame encode
+    if not FFMPEG:
+        return None
+    for name, args in HW_ENCODERS.items():
+        try:
+            ok = subprocess.run(
+                [FFMPEG, "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i", "nullsrc=s=256x256",
+                 "-frames:v", "1", *args, "-f", "null", "-"],
+                capture_output=True, timeout=15,
+            ).returncode == 0
+        except (OSError, subprocess.SubprocessError):
+            ok = False
+        if ok:
+            return name
+    return None
+
+
+HW_ENCODER = detect_hw_encoder()
+
+
+def needs_reencode(info: Dict[str, Any]) -> bool:
+    # the remux keeps the source codec; only non-H.264 video (VP9/AV1 fallbacks) is worth re-encoding
+    vcodec = str(info.get("vcodec") or "")
+    return vcodec not in ("", "none") and not vcodec.startswith(("avc1", "h264"))
+
+
+def reencode_h264(path: Path, info: Dict[str, Any]) -> Path:
+    tmp = path.with_name(path.stem + ".h264.mp4")
+    audio = ["-c:a", "copy"] if str(info.get("acodec") or "").startswith("mp4a") else ["-c:a", "aac"]
+    try:
+        subprocess.run(
+            [FFMPEG, "-hide_banner", "-loglevel", "error", "-y", "-i", str(path),
+             *HW_ENCODERS[HW_ENCODER], *audio, "-movflags", "+faststart", str(tmp)],
+            check=True,
+        )
+    except subprocess.CalledProcessError as e:
+        # the startup probe can't catch every driver/input problem; the remuxed mp4 is still usable
+        print(f"[ffmpeg] {HW_ENCODER} re-encode failed ({e.returncode}), keeping remuxed file")
+        tmp.unlink(missing_ok=True)
+        return path
+    os.replace(tmp, path)
+    return path
+
 
 def human(s: int) -> str:
     m, s = divmod(int(s), 60)
@@ -85,32 +166,52 @@ class Video:
     filepath: Path
 
 
+_YT_RE = re.compile(r"(?:youtube\.com|youtu\.be)", re.IGNORECASE)
+
+
 def is_youtube_url(url: str) -> bool:
-    return bool(re.search(r"(youtube\.com|youtu\.be)", url))
+    return _YT_RE.search(url) is not None
 
 
+@functools.lru_cache(maxsize=8)
 def build_format_selector(max_height: int) -> str:
     # Prefer mp4 up to max_height, fallback to best <= max_height, then best
     return f"bestvideo[ext=mp4][height<={max_height}]+bestaudio[ext=m4a]/best[ext=mp4][height<={max_height}]/best[height<={max_height}]/best"
 
 
-def ytdl_extract(url: str, max_height: int) -> Dict[str, Any]:
-    opts = {
-        **YDL_OPTS_BASE,
-        "format": build_format_selector(max_height),
-    }
-    with YoutubeDL(opts) as ydl:
+# merged once at import; pooled YoutubeDL instances each take a copy (see pooled_ydl)
+YDL_OPTS = {**YDL_OPTS_BASE, "format": build_format_selector(MAX_HEIGHT)}
+
+
+# YoutubeDL is expensive to build (extractors, regexes, cookiejar) and not safe to share
+# between threads, so keep a pool of instances: each worker thread checks one out at a time.
+# YoutubeDL keeps the params dict by reference, so every instance gets its own copy.
+_ydl_pool: "queue.SimpleQueue[YoutubeDL]" = queue.SimpleQueue()
+
+
+@contextlib.contextmanager
+def pooled_ydl():
+    try:
+        ydl = _ydl_pool.get_nowait()
+    except queue.Empty:
+        ydl = YoutubeDL({**YDL_OPTS})
+    try:
+        yield ydl
+    finally:
+        _ydl_pool.put(ydl)
+
+
+def ytdl_extract(url: str) -> Dict[str, Any]:
+    with pooled_ydl() as ydl:
         info = ydl.extract_info(url, download=False)
     return info
 
 
-def ytdl_download(info: Dict[str, Any]) -> Path:
-    opts = {
-        **YDL_OPTS_BASE,
-        "format": build_format_selector(MAX_HEIGHT),
-        "outtmpl": f"%(id)s.%(ext)s",
-    }
-    with YoutubeDL(opts) as ydl:
+def ytdl_download(info: Dict[str, Any], dest_dir: Path) -> Path:
+    with pooled_ydl() as ydl:
+        # this instance's params are its own copy and it is checked out by this thread only,
+        # so pointing it at dest_dir can't redirect another download
+        ydl.params["paths"] = {"home": str(dest_dir)}
         res = ydl.process_ie_result(info, download=True)
         filename = ydl.prepare_filename(res)
     # Ensure mp4 extension after postprocess
@@ -119,20 +220,54 @@ def ytdl_download(info: Dict[str, Any]) -> Path:
         alt = p.with_suffix(".mp4")
         if alt.exists():
             p = alt
+    # CPU-only hosts keep the remuxed file as is; software x264 would cost seconds per video
+    if HW_ENCODER and needs_reencode(res):
+        p = reencode_h264(p, res)
     return p
 
 
+# yt-dlp is blocking (network + ffmpeg), so run it in worker threads to keep the bot responsive.
+# A dedicated bounded pool caps how many ffmpeg postprocess runs compete for the CPU; extra jobs queue.
+_ytdl_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=MAX_CONCURRENT_DOWNLOADS, thread_name_prefix="ytdl"
+)
+
+
+async def ytdl_extract_async(url: str) -> Dict[str, Any]:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_ytdl_executor, ytdl_extract, url)
+
+
+async def ytdl_download_async(info: Dict[str, Any], dest_dir: Path) -> Path:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_ytdl_executor, ytdl_download, info, dest_dir)
+
+
+def load_input_file(path: Path) -> InputFile:
+    with path.open("rb") as fh:
+        return InputFile(fh, filename=path.name)
+
+
 async def send_video(context: ContextTypes.DEFAULT_TYPE, chat_id: str | int, video: Video) -> None:
-    caption = (
-        f"<b>{video.title}</b>\n"
+    details = (
         f"⏱ {human(video.duration)}  •  👤 {video.uploader}\n"
         f"\n<a href='{video.url}'>YouTube</a>"
     )
+    # trim only the title to fit Telegram's 1024-char caption limit, so the link is never cut off
+    title = video.title[: max(0, CAPTION_LIMIT - len(details) - len("<b></b>\n"))]
+    caption = f"<b>{title}</b>\n{details}"
+    if context.bot.local_mode:
+        # the local Bot API server reads the file itself, nothing is uploaded
+        video_file = video.filepath
+    else:
+        # PTB has no streaming upload path (InputFile always .read()s its source), so do the disk
+        # read in a worker thread rather than on the event loop.
+        video_file = await asyncio.to_thread(load_input_file, video.filepath)
     await context.bot.send_video(
         chat_id=chat_id,
-        video=video.filepath.read_bytes(),
+        video=video_file,
         supports_streaming=True,
-        caption=caption[:1024],
+        caption=caption,
         parse_mode=ParseMode.HTML,
     )
 
@@ -162,24 +297,21 @@ async def handle_short(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
     await update.message.reply_text("Скачиваю…")
     try:
-        info = ytdl_extract(url, MAX_HEIGHT)
+        info = await ytdl_extract_async(url)
         duration = int(info.get("duration") or 0)
         if duration and duration > MAX_DURATION_SECONDS:
             await update.message.reply_text(
                 f"Это видео {human(duration)} — длиннее лимита {MAX_DURATION_SECONDS}s. Пропускаю."
             )
             return
-        path = ytdl_download(info)
-        video = to_video(info, path)
-        await send_video(context, update.effective_chat.id, video)
+        # private download dir: removed on exit and can't collide with concurrent downloads
+        with tempfile.TemporaryDirectory() as td:
+            path = await ytdl_download_async(info, Path(td))
+            video = to_video(info, path)
+            await send_video(context, update.effective_chat.id, video)
         await update.message.reply_text("Готово ✅")
     except Exception as e:
         await update.message.reply_text(f"Ошибка: {e}")
-    finally:
-        with contextlib.suppress(Exception):
-            # clean up downloaded files
-            for f in Path.cwd().glob(f"{info.get('id','*')}.*"):
-                f.unlink(missing_ok=True)
 
 
 # --- Auto-sync from a channel RSS ---
@@ -188,53 +320,198 @@ def rss_url(channel_id: str) -> str:
     return f"https://www.youtube.com/feeds/videos.xml?channel_id={channel_id}"
 
 
-def load_state() -> Dict[str, float]:
-    if STATE_FILE.exists():
-        with STATE_FILE.open("r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
-
-
-def save_state(state: Dict[str, float]) -> None:
-    with STATE_FILE.open("w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+async def fetch_feed(session: aiohttp.ClientSession, url: str, state: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # conditional GET: YouTube answers 304 with no body when the feed is unchanged -> None
+    headers = {}
+    if state.get("_etag"):
+        headers["If-None-Match"] = state["_etag"]
+    if state.get("_modified"):
+        headers["If-Modified-Since"] = state["_modified"]
+    async with session.get(url, headers=headers) as r:
+        if r.status == 304:
+            return None
+        r.raise_for_status()
+        body = await r.read()
+        etag, modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+    feed = await asyncio.to_thread(feedparser.parse, body)
+    feed["etag"], feed["modified"] = etag, modified
+    return feed
+
+
+def adaptive_interval(entries: list, recent: int = 10) -> float:
+    # Poll roughly 4x per typical gap between uploads, never faster than POLL_INTERVAL
+    stamps = sorted(calendar.timegm(e["published_parsed"]) for e in entries if e.get("published_parsed"))[-recent:]
+    if len(stamps) < 2:
+        return POLL_INTERVAL
+    median_delta = statistics.median(b - a for a, b in zip(stamps, stamps[1:]))
+    return min(max(POLL_INTERVAL, median_delta / 4), MAX_POLL_INTERVAL)
+
+
+_EPOCH = time.gmtime(0)
+
+
+# State = JSON snapshot (STATE_FILE) + append-only log (STATE_LOG) of "key\t<json value>" lines,
+# so recording a posted video is a single O_APPEND write instead of rewriting the whole dict.
+_state_log_lines = 0
+_STATE_META = {"_etag", "_modified", "_interval"}
+
+
+def trim_state(state: collections.OrderedDict[str, Any]) -> None:
+    # evict oldest video IDs first; feed validators are kept
+    while len(state) > STATE_MAX_ENTRIES:
+        key, value = state.popitem(last=False)
+        if key in _STATE_META:
+            state[key] = value
+
+
+def load_state() -> collections.OrderedDict[str, Any]:
+    global _state_log_lines
+    state = collections.OrderedDict(orjson.loads(STATE_FILE.read_bytes()) if STATE_FILE.exists() else {})
+    _state_log_lines = 0
+    if STATE_LOG.exists():
+        for line in STATE_LOG.read_bytes().splitlines():
+            key, sep, value = line.partition(b"\t")
+            if not sep:
+                continue  # torn last line after a crash
+            with contextlib.suppress(orjson.JSONDecodeError):
+                state[key.decode()] = orjson.loads(value)
+                _state_log_lines += 1
+    trim_state(state)
+    return state
+
+
+def save_state(state: Dict[str, Any]) -> None:
+    # write to a sibling file and rename over, so a crash mid-write can't corrupt the state
+    tmp = STATE_FILE.with_name(STATE_FILE.name + ".tmp")
+    tmp.write_bytes(orjson.dumps(state, option=orjson.OPT_INDENT_2))
+    os.replace(tmp, STATE_FILE)
+
+
+def compact_state(state: Dict[str, Any]) -> None:
+    global _state_log_lines
+    save_state(state)
+    STATE_LOG.unlink(missing_ok=True)
+    _state_log_lines = 0
+
+
+def record_state(state: collections.OrderedDict[str, Any], key: str, value: Any) -> None:
+    global _state_log_lines
+    state[key] = value
+    trim_state(state)
+    fd = os.open(STATE_LOG, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, key.encode() + b"\t" + orjson.dumps(value) + b"\n")
+    finally:
+        os.close(fd)
+    _state_log_lines += 1
+    if _state_log_lines >= STATE_COMPACT_EVERY:
+        compact_state(state)
 
 
 async def sync_loop(app: Application) -> None:
     if not (YT_CHANNEL_ID and TARGET_CHAT_ID):
         return
     state = load_state()
+    if _state_log_lines:
+        compact_state(state)
     url = rss_url(YT_CHANNEL_ID)
     print(f"[sync] watching {url}")
-    while True:
+    session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+    try:
+        await _sync_forever(app, session, url, state)
+    finally:
+        await session.close()
+
+
+async def download_entry(state: Dict[str, Any], vid_id: str) -> Optional[tuple[Video, tempfile.TemporaryDirectory]]:
+    watch_url = f"https://www.youtube.com/watch?v={vid_id}"
+    # probe
+    info = await ytdl_extract_async(watch_url)
+    duration = int(info.get("duration") or 0)
+    if duration and duration > MAX_DURATION_SECONDS:
+        record_state(state, vid_id, time.time())
+        return None
+    # the temp dir outlives this call: the uploader removes it once the video is sent
+    td = tempfile.TemporaryDirectory()
+    try:
+        path = await ytdl_download_async(info, Path(td.name))
+    except BaseException:
+        td.cleanup()
+        raise
+    return to_video(info, path), td
+
+
+async def upload_entries(
+    app: Application, state: Dict[str, Any], pending: asyncio.Queue, slots: asyncio.Semaphore
+) -> list[Exception]:
+    # entries arrive in feed order as (vid_id, download task); awaiting them in that order keeps posts in upload order
+    errors: list[Exception] = []
+    while (item := await pending.get()) is not None:
+        vid_id, download = item
         try:
-            feed = feedparser.parse(url)
-            entries = feed.entries or []
-            # newest first
-            entries.sort(key=lambda e: e.get("published_parsed") or time.gmtime(0))
-            for e in entries:
-                vid_id = e.get("yt_videoid") or e.get("id")
-                if not vid_id or state.get(vid_id):
-                    continue
-                watch_url = f"https://www.youtube.com/watch?v={vid_id}"
-                # probe
-                info = ytdl_extract(watch_url, MAX_HEIGHT)
-                duration = int(info.get("duration") or 0)
-                if duration and duration > MAX_DURATION_SECONDS:
-                    state[vid_id] = time.time()
-                    continue
-                path = ytdl_download(info)
-                video = to_video(info, path)
-                await send_video(app.bot, TARGET_CHAT_ID, video)
-                state[vid_id] = time.time()
-                save_state(state)
-                with contextlib.suppress(Exception):
-                    for f in Path.cwd().glob(f"{video.id}.*"):
-                        f.unlink(missing_ok=True)
+            result = await download
+            if result is None:
+                continue
+            video, td = result
+            try:
+                await send_video(app, TARGET_CHAT_ID, video)
+                record_state(state, vid_id, time.time())
                 print(f"[sync] posted {video.id} {video.title}")
+            finally:
+                td.cleanup()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            slots.release()  # this entry's files are gone, let the next download start
+    return errors
+
+
+async def _sync_forever(app: Application, session: aiohttp.ClientSession, url: str, state: Dict[str, Any]) -> None:
+    # restored from state: after a restart the first poll is usually a 304, which can't recompute it
+    interval = min(max(POLL_INTERVAL, state.get("_interval") or 0), MAX_POLL_INTERVAL)
+    while True:
+        try:
+            feed = await fetch_feed(session, url, state)
+            unchanged = feed is None
+            entries = [] if unchanged else (feed.entries or [])
+            # oldest first, so posts go out in upload order; int keys compare faster than struct_time
+            entries.sort(key=lambda e: calendar.timegm(e.get("published_parsed") or _EPOCH))
+            new_ids = [vid_id for e in entries if (vid_id := e.get("yt_videoid") or e.get("id")) and not state.get(vid_id)]
+
+            # downloads run concurrently while a single uploader posts them one by one in feed order.
+            # A slot is held from download start until the uploader has sent and removed the file,
+            # so at most SYNC_CONCURRENCY videos are downloading or waiting on disk at any time.
+            slots = asyncio.Semaphore(SYNC_CONCURRENCY)
+            pending: asyncio.Queue = asyncio.Queue()
+            uploader = asyncio.create_task(upload_entries(app, state, pending, slots))
+            downloads = []
+            try:
+                for vid_id in new_ids:
+                    await slots.acquire()
+                    downloads.append(asyncio.create_task(download_entry(state, vid_id)))
+                    pending.put_nowait((vid_id, downloads[-1]))
+                pending.put_nowait(None)
+                errors = await uploader
+            finally:
+                uploader.cancel()
+                for task in downloads:
+                    task.cancel()
+            for err in errors:
+                print("[sync] error:", err)
+            if errors:
+                # failed posts are retried next tick, so don't stretch the wait (or persist it) this time
+                interval = POLL_INTERVAL
+            elif not unchanged:
+                interval = adaptive_interval(entries)
+                if interval != state.get("_interval"):
+                    record_state(state, "_interval", interval)
+            # remember validators only once every entry went through, so a failed post is retried
+            if not unchanged and not errors and (feed.get("etag") or feed.get("modified")):
+                record_state(state, "_etag", feed.get("etag"))
+                record_state(state, "_modified", feed.get("modified"))
         except Exception as e:
             print("[sync] error:", e)
-        await asyncio.sleep(POLL_INTERVAL)
+        await asyncio.sleep(interval)
 
 
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -253,7 +530,16 @@ async def main() -> None:
     if not TELEGRAM_BOT_TOKEN:
         raise SystemExit("Set TELEGRAM_BOT_TOKEN env var")
 
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # pace outgoing calls under Telegram's flood limits; on a 429 wait retry_after and retry (up to 3 times)
+    rate_limiter = AIORateLimiter(overall_max_rate=30, group_max_rate=20, group_time_period=60, max_retries=3)
+    builder = Application.builder().token(TELEGRAM_BOT_TOKEN).rate_limiter(rate_limiter)
+    if LOCAL_BOT_API_URL:
+        builder = (
+            builder.base_url(f"{LOCAL_BOT_API_URL}/bot")
+            .base_file_url(f"{LOCAL_BOT_API_URL}/file/bot")
+            .local_mode(True)
+        )
+    app = builder.build()
     app.add_handler(CommandHandler("start", start_cmd))
     app.add_handler(CommandHandler("short", handle_short))
     app.add_handler(MessageHandler(filters.COMMAND, unknown))